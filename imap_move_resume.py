@@ -1,23 +1,42 @@
 import json
+import re
+import sys
 import yaml
+try:
+    # libyaml-backed loader; ~10x faster on large mapping files.
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 import argparse
 import logging
 import sqlite3
 import time
 import threading
+import queue
 from imapclient import IMAPClient
-from email.parser import BytesParser
-from email.policy import default as default_policy
+from imapclient.exceptions import IMAPClientError
 import imaplib
 
+# Matches the Message-ID header in a raw RFC822 header block.
+MSGID_RE = re.compile(rb'^Message-ID:\s*(<[^>]+>)', re.I | re.M)
+
+def extract_message_id(msg_bytes):
+    # A header-only scan is orders of magnitude cheaper than parsing the
+    # whole MIME structure just to read one header.
+    header_end = msg_bytes.find(b'\r\n\r\n')
+    if header_end == -1:
+        header_end = len(msg_bytes)
+    m = MSGID_RE.search(msg_bytes, 0, header_end)
+    return m.group(1).decode('ascii', 'replace') if m else None
+
 # --- Database schema for resume support ---
 DB_SCHEMA = """
 CREATE TABLE IF NOT EXISTS transfers (
     id INTEGER PRIMARY KEY,
     src_mailbox TEXT NOT NULL,
-    src_uid TEXT NOT NULL,
+    src_uid INTEGER NOT NULL,
     dst_mailbox TEXT,
-    dst_uid TEXT,
+    dst_uid INTEGER,
     message_id TEXT,
     transferred_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     UNIQUE(src_mailbox, src_uid)
@@ -25,24 +44,35 @@ CREATE TABLE IF NOT EXISTS transfers (
 CREATE INDEX IF NOT EXISTS idx_message_id ON transfers(message_id);
 """
 
+INSERT_TRANSFER_SQL = (
+    'INSERT OR REPLACE INTO transfers '
+    '(src_mailbox, src_uid, dst_mailbox, dst_uid, message_id) VALUES (?,?,?,?,?)'
+)
+
 def open_db(path: str):
-    conn = sqlite3.connect(path)
+    # isolation_level=None disables the implicit-BEGIN legacy mode so
+    # transactions start exactly where we issue BEGIN; check_same_thread is
+    # off because the connection may be handed between worker threads.
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False,
+                           cached_statements=256)
     conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA cache_size=-65536')  # 64 MiB page cache
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA wal_autocheckpoint=1000')
     conn.executescript(DB_SCHEMA)
-    conn.commit()
     return conn
 
-def record_transfer(conn, src_mailbox, src_uid, dst_mailbox, dst_uid, message_id):
-    conn.execute(
-        'INSERT OR REPLACE INTO transfers (src_mailbox, src_uid, dst_mailbox, dst_uid, message_id) VALUES (?,?,?,?,?)',
-        (src_mailbox, str(src_uid), dst_mailbox, str(dst_uid) if dst_uid else None, message_id),
-    )
-    conn.commit()
+def record_transfers(conn, rows):
+    # rows: list of (src_mailbox, src_uid, dst_mailbox, dst_uid, message_id) tuples.
+    # Caller is responsible for committing; one commit per batch keeps fsyncs
+    # down to one per FETCH batch instead of one per message.
+    conn.executemany(INSERT_TRANSFER_SQL, rows)
 
-def already_transferred_by_src(conn, src_mailbox, src_uid):
-    cur = conn.execute('SELECT 1 FROM transfers WHERE src_mailbox = ? AND src_uid = ? LIMIT 1',
-                       (src_mailbox, str(src_uid)))
-    return cur.fetchone()
+def load_transferred_uids(conn, src_mailbox):
+    cur = conn.execute('SELECT src_uid FROM transfers WHERE src_mailbox = ?', (src_mailbox,))
+    return {int(row[0]) for row in cur}
 
 # --- IMAP connection helpers ---
 def connect_imap(host, username, password, port=None, ssl=True):
@@ -67,28 +97,14 @@ def ensure_mailbox(client, mailbox):
     try:
         client.select_folder(mailbox)
         return True
-    except:
+    except IMAPClientError:
         try:
             client.create_folder(mailbox)
             return True
-        except:
+        except IMAPClientError:
             logging.warning(f'Could not create mailbox {mailbox}')
             return False
 
-# --- Spinner for visual feedback ---
-def spinner_task(stop_event):
-    spinner_chars = '|/-\\'
-    idx = 0
-    last_log_time = time.time()
-    while not stop_event.is_set():
-        print(spinner_chars[idx % len(spinner_chars)], end='\r', flush=True)
-        idx += 1
-        if time.time() - last_log_time > 15:
-            logging.info("Migration still in progress...")
-            last_log_time = time.time()
-        time.sleep(0.1)
-    print(' ', end='\r', flush=True)
-
 # --- Safe search with retries ---
 def safe_search(client, criteria='ALL', max_retries=5, base_delay=5):
     for attempt in range(1, max_retries + 1):
@@ -100,97 +116,257 @@ def safe_search(client, criteria='ALL', max_retries=5, base_delay=5):
                 raise
             time.sleep(base_delay * attempt)
 
-# --- Main migration logic ---
-def migrate_mailbox(src_cfg, dst_cfg, conn_db, src_mailbox, dst_mailbox, batch=50, sleep_between=2, dry_run=False):
-    src_host, src_user, src_pass, src_port, src_ssl = src_cfg
-    dst_host, dst_user, dst_pass, dst_port, dst_ssl = dst_cfg
+def plan_batches(uids, sizes, max_messages, max_bytes):
+    # Greedily pack UIDs into batches capped by both message count and total
+    # message bytes, so folders of tiny messages get big batches while a run
+    # of 20 MB attachments doesn't blow past server request limits (or RAM).
+    batches = []
+    current, current_bytes = [], 0
+    for uid in uids:
+        size = sizes.get(uid, 0)
+        if current and (len(current) >= max_messages or current_bytes + size > max_bytes):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(uid)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
 
+# --- Main migration logic ---
+def migrate_mailbox(src, dst, src_cfg, dst_cfg, conn_db, src_mailbox, dst_mailbox,
+                    batch=200, batch_bytes=32 * 1024 * 1024, sleep_between=0,
+                    dry_run=False, archive_src=False):
+    # src/dst are live IMAP clients owned by the caller; the cfg tuples are
+    # only needed to reconnect after an abort. Returns the (possibly
+    # reconnected) clients so the caller can keep reusing them.
     logging.info(f'Migrating {src_mailbox} -> {dst_mailbox}')
-    src = connect_imap(*src_cfg)
-    dst = connect_imap(*dst_cfg)
 
     if not ensure_mailbox(dst, dst_mailbox):
-        src.logout()
-        dst.logout()
-        return
+        return src, dst
 
-    archive_mailbox = f"Migrated/{src_mailbox}"
-    ensure_mailbox(src, archive_mailbox)
+    # MULTIAPPEND (RFC 3502) lets one APPEND command carry a whole batch,
+    # amortizing the server's per-command mailbox locking.
+    try:
+        can_multiappend = b'MULTIAPPEND' in dst.capabilities()
+    except IMAPClientError:
+        can_multiappend = False
+
+    # Archiving doubles the write volume on the source server, so it is
+    # opt-in; the default is a pure one-way copy.
+    archive_mailbox = None
+    if archive_src:
+        archive_mailbox = f"Migrated/{src_mailbox}"
+        ensure_mailbox(src, archive_mailbox)
 
     try:
         src.select_folder(src_mailbox, readonly=False)
     except Exception as e:
         logging.error(f"Cannot select source folder {src_mailbox}: {e}")
-        src.logout()
-        dst.logout()
-        return
+        return src, dst
 
     try:
         uids = safe_search(src, 'ALL')
     except Exception as e:
         logging.error(f"SEARCH failed on {src_mailbox}: {e}")
-        src.logout()
-        dst.logout()
-        return
-
-    stop_spinner = threading.Event()
-    spinner_thread = threading.Thread(target=spinner_task, args=(stop_spinner,))
-    spinner_thread.start()
-
+        return src, dst
+
+    done = load_transferred_uids(conn_db, src_mailbox)
+    # Drop already-transferred UIDs before batching so RFC822 bodies are only
+    # fetched for messages that still need to cross the wire.
+    uids = [u for u in uids if u not in done]
+
+    # RFC822.SIZE is cheap (one number per message) and lets us batch by
+    # bytes rather than a fixed message count. Fetch it in chunks: IMAPClient
+    # joins the UID list into one command line, and tens of thousands of UIDs
+    # would overflow server command-length limits.
+    sizes = {}
     try:
-        for i in range(0, len(uids), batch):
-            batch_uids = uids[i:i+batch]
-            fetch_data = None
-
-            for attempt in range(3):
-                try:
-                    fetch_data = src.fetch(batch_uids, ['RFC822', 'FLAGS', 'INTERNALDATE'])
+        for i in range(0, len(uids), 1000):
+            chunk = uids[i:i+1000]
+            size_data = src.fetch(chunk, ['RFC822.SIZE'])
+            for uid, data in size_data.items():
+                sizes[uid] = data.get(b'RFC822.SIZE', 0)
+    except (IMAPClientError, imaplib.IMAP4.error) as e:
+        logging.warning(f"SIZE fetch failed: {e}, falling back to count-only batching")
+        sizes = {}
+    if sizes:
+        batch_plan = plan_batches(uids, sizes, batch, batch_bytes)
+    else:
+        # Without sizes the byte cap can never trigger, so a 200-message
+        # batch of large attachments would dwarf the old fixed batches; keep
+        # the degraded path at the conservative pre-size-planning count.
+        batch_plan = plan_batches(uids, sizes, 50, batch_bytes)
+
+    # Pipeline FETCH and APPEND: a producer thread pulls batches from src
+    # while this thread appends to dst, so both sockets stay busy. The src
+    # client is shared between the producer (FETCH) and this thread (MOVE to
+    # the archive folder), so every src command takes src_lock. Reconnects
+    # swap clients in-place via the holder dict.
+    clients = {'src': src, 'dst': dst}
+    src_lock = threading.Lock()
+    batches = queue.Queue(maxsize=2)
+    cancel = threading.Event()
+
+    def fetch_batches():
+        try:
+            for batch_uids in batch_plan:
+                # Set when the consumer bails out mid-mailbox; stop fetching
+                # instead of downloading batches that would be thrown away.
+                if cancel.is_set():
                     break
-                except imaplib.IMAP4.abort as e:
-                    logging.warning(f"FETCH abort: {e}, reconnecting source...")
-                    src = reconnect_imap(src, *src_cfg)
-                    src.select_folder(src_mailbox, readonly=False)
-            if fetch_data is None:
-                continue
+                fetch_data = None
+                had_abort = False
 
-            for uid in batch_uids:
-                if already_transferred_by_src(conn_db, src_mailbox, uid):
-                    continue
-                raw_msg = fetch_data.get(uid)
-                if not raw_msg:
+                for attempt in range(3):
+                    try:
+                        with src_lock:
+                            # BODY.PEEK[] returns the same bytes as RFC822 but
+                            # does not set \Seen on every fetched message.
+                            fetch_data = clients['src'].fetch(batch_uids, ['BODY.PEEK[]', 'FLAGS', 'INTERNALDATE'])
+                        break
+                    except imaplib.IMAP4.abort as e:
+                        logging.warning(f"FETCH abort: {e}, reconnecting source...")
+                        had_abort = True
+                        with src_lock:
+                            clients['src'] = reconnect_imap(clients['src'], *src_cfg)
+                            clients['src'].select_folder(src_mailbox, readonly=False)
+                if fetch_data is None:
                     continue
-                msg_bytes = raw_msg[b'RFC822']
-                parser = BytesParser(policy=default_policy)
-                msg = parser.parsebytes(msg_bytes)
-                message_id = msg.get('Message-ID')
 
-                if not dry_run:
-                    for attempt in range(3):
-                        try:
-                            dst.append(dst_mailbox, msg_bytes,
-                                       flags=raw_msg[b'FLAGS'],
-                                       msg_time=raw_msg[b'INTERNALDATE'])
-                            break
-                        except imaplib.IMAP4.abort as e:
-                            logging.warning(f"APPEND abort: {e}, reconnecting destination...")
-                            dst = reconnect_imap(dst, *dst_cfg)
-                            ensure_mailbox(dst, dst_mailbox)
-
-                    try:
-                        src.move([uid], archive_mailbox)
-                    except Exception as e:
-                        logging.error(f"Failed to move UID {uid} to archive: {e}")
+                messages = []
+                for uid in batch_uids:
+                    # pop() drops the response entry immediately so the batch
+                    # is never held both in fetch_data and in messages.
+                    raw_msg = fetch_data.pop(uid, None)
+                    if not raw_msg:
                         continue
+                    messages.append((uid, raw_msg[b'BODY[]'],
+                                     raw_msg[b'FLAGS'], raw_msg[b'INTERNALDATE']))
+                batches.put(messages)
+
+                # Throttle reactively: only back off after the server aborted
+                # this batch, never unconditionally between healthy batches.
+                if had_abort and sleep_between > 0:
+                    time.sleep(sleep_between)
+        except Exception as e:
+            # A tagged NO/BAD or a failed reconnect must not end the mailbox
+            # as if complete; hand the exception to the consumer so
+            # migrate_mailbox re-raises it and the failure is reported.
+            batches.put(e)
+        finally:
+            batches.put(None)
+
+    producer = threading.Thread(target=fetch_batches)
+    producer.start()
+
+    processed = 0
+    committed_batches = 0
+    last_log = time.time()
+    try:
+        while True:
+            messages = batches.get()
+            if messages is None:
+                break
+            if isinstance(messages, Exception):
+                raise messages
+            processed += len(messages)
+
+            transferred_rows = []
+            to_archive = []
+
+            use_multiappend = not dry_run and can_multiappend and len(messages) > 1
+            if use_multiappend:
+                msgs = [{'msg': body, 'flags': flags, 'date': date}
+                        for _uid, body, flags, date in messages]
+                appended = False
+                for attempt in range(3):
+                    try:
+                        clients['dst'].multiappend(dst_mailbox, msgs)
+                        appended = True
+                        break
+                    except imaplib.IMAP4.abort as e:
+                        logging.warning(f"MULTIAPPEND abort: {e}, reconnecting destination...")
+                        clients['dst'] = reconnect_imap(clients['dst'], *dst_cfg)
+                        clients['dst'].select_folder(dst_mailbox)
+                del msgs
+                if not appended:
+                    # Leave the batch unrecorded so the next run retries it.
+                    continue
 
-                record_transfer(conn_db, src_mailbox, uid, dst_mailbox, None, message_id)
+            for idx in range(len(messages)):
+                uid, msg_bytes, flags, internaldate = messages[idx]
+                # Clear the slot so each body is reclaimed right after its
+                # APPEND instead of at the end of the batch.
+                messages[idx] = None
+                message_id = extract_message_id(msg_bytes)
 
-            if sleep_between > 0:
-                time.sleep(sleep_between)
+                if not dry_run:
+                    if not use_multiappend:
+                        appended = False
+                        for attempt in range(3):
+                            try:
+                                clients['dst'].append(dst_mailbox, msg_bytes,
+                                                      flags=flags, msg_time=internaldate)
+                                appended = True
+                                break
+                            except imaplib.IMAP4.abort as e:
+                                logging.warning(f"APPEND abort: {e}, reconnecting destination...")
+                                clients['dst'] = reconnect_imap(clients['dst'], *dst_cfg)
+                                # The folder was created (or found) by the
+                                # ensure_mailbox call at the top of this
+                                # function, so a plain SELECT is enough after
+                                # a reconnect.
+                                clients['dst'].select_folder(dst_mailbox)
+                        if not appended:
+                            # Leave the message unarchived and unrecorded so
+                            # the next run retries it.
+                            logging.error(f"APPEND failed for UID {uid} after retries")
+                            continue
+                    to_archive.append(uid)
+
+                transferred_rows.append((src_mailbox, uid, dst_mailbox, None, message_id))
+
+            # MOVE accepts a UID set, so archive the whole batch in one
+            # command instead of one round-trip per message.
+            if archive_src and to_archive:
+                try:
+                    with src_lock:
+                        clients['src'].move(to_archive, archive_mailbox)
+                except IMAPClientError as e:
+                    logging.error(f"Failed to move {len(to_archive)} UIDs to archive: {e}")
+                    # Leave the batch unrecorded so the next run retries it.
+                    continue
+
+            if transferred_rows:
+                conn_db.execute('BEGIN')
+                record_transfers(conn_db, transferred_rows)
+                conn_db.execute('COMMIT')
+                committed_batches += 1
+                if committed_batches % 100 == 0:
+                    # Truncate the WAL periodically so it stays bounded over
+                    # multi-hour runs instead of relying on the passive
+                    # autocheckpoint keeping up.
+                    conn_db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+            if time.time() - last_log > 15:
+                logging.info(f'{src_mailbox}: {processed}/{len(uids)} messages migrated')
+                last_log = time.time()
     finally:
-        stop_spinner.set()
-        spinner_thread.join()
-        src.logout()
-        dst.logout()
+        # Roll back a batch transaction left open by an exception; with
+        # explicit BEGIN/COMMIT this is a no-op on the normal path.
+        conn_db.rollback()
+        # Stop the producer and unblock it if we bailed out mid-mailbox, then
+        # wait for it to finish its in-flight batch.
+        cancel.set()
+        while producer.is_alive():
+            try:
+                batches.get_nowait()
+            except queue.Empty:
+                time.sleep(0.1)
+        producer.join()
+
+    return clients['src'], clients['dst']
 
 # --- Loaders ---
 def load_mapping(path):
@@ -198,7 +374,7 @@ def load_mapping(path):
         if path.endswith('.json'):
             return json.load(f)
         elif path.endswith(('.yml', '.yaml')):
-            return yaml.safe_load(f)
+            return yaml.load(f, Loader=YamlLoader)
         else:
             raise ValueError('Mapping file must be JSON or YAML')
 
@@ -208,7 +384,7 @@ def load_exclude_list(path):
 
 def load_config(path):
     with open(path, 'r', encoding='utf-8') as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=YamlLoader)
 
 # --- CLI parsing ---
 def parse_args():
@@ -217,10 +393,65 @@ def parse_args():
     p.add_argument('--mapping-file')
     p.add_argument('--exclude-file')
     p.add_argument('--dry-run', action='store_true')
+    p.add_argument('--archive-src', action='store_true')
+    p.add_argument('--workers', type=int, default=4)
     p.add_argument('--verbose', action='store_true')
     return p.parse_args()
 
 # --- Main ---
+def worker_loop(work_queue, src_cfg, dst_cfg, db_path, dry_run, archive_src, failures):
+    # Each worker owns one src/dst IMAP session pair and one SQLite
+    # connection, reused across all the mailboxes it pulls off the queue.
+    # Providers cap concurrent connections per account, so keep --workers
+    # conservative.
+    try:
+        src = connect_imap(*src_cfg)
+        dst = connect_imap(*dst_cfg)
+        conn_db = open_db(db_path)
+    except Exception as e:
+        # Record the failure so main can report it and exit non-zero instead
+        # of silently finishing with the queue undrained.
+        logging.error(f"Worker startup failed: {e}")
+        failures.append(e)
+        return
+    try:
+        while True:
+            try:
+                src_mailbox, dst_mailbox = work_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                src, dst = migrate_mailbox(src, dst, src_cfg, dst_cfg, conn_db,
+                                           src_mailbox, dst_mailbox, dry_run=dry_run,
+                                           archive_src=archive_src)
+            except Exception as e:
+                logging.error(f"Migration of {src_mailbox} failed: {e}")
+                failures.append(e)
+                # A failed reconnect inside migrate_mailbox may have logged
+                # out one of our clients; rebuild the pair so the remaining
+                # mailboxes don't inherit dead connections.
+                try:
+                    src = reconnect_imap(src, *src_cfg)
+                    dst = reconnect_imap(dst, *dst_cfg)
+                except Exception as e:
+                    logging.error(f"Worker could not re-establish connections: {e}")
+                    failures.append(e)
+                    break
+                continue
+            try:
+                src.close_folder()
+            except IMAPClientError:
+                pass
+    finally:
+        # The clients may already be dead if we bailed out on a failed
+        # reconnect; a best-effort logout is all that's left to do.
+        for client in (src, dst):
+            try:
+                client.logout()
+            except Exception:
+                pass
+        conn_db.close()
+
 def main():
     args = parse_args()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
@@ -231,7 +462,9 @@ def main():
     if exclude_folders:
         logging.info(f'Excluding folders: {exclude_folders}')
 
-    conn_db = open_db(config['database']['path'])
+    db_path = config['database']['path']
+    # Create the schema once up front so workers never race on DDL.
+    open_db(db_path).close()
     src_cfg = (config['source']['host'], config['source']['user'], config['source']['pass'],
                config['source'].get('port'), config['source'].get('ssl', True))
     dst_cfg = (config['destination']['host'], config['destination']['user'], config['destination']['pass'],
@@ -243,14 +476,33 @@ def main():
     mailboxes = list_mailboxes(src)
     src.logout()
 
+    work_queue = queue.Queue()
     for src_mailbox in mailboxes:
         if src_mailbox in exclude_folders:
             logging.info(f"Skipping excluded folder: {src_mailbox}")
             continue
         dst_mailbox = mapping.get(src_mailbox, src_mailbox) if mapping else src_mailbox
-        migrate_mailbox(src_cfg, dst_cfg, conn_db, src_mailbox, dst_mailbox, dry_run=args.dry_run)
-
-    conn_db.close()
+        work_queue.put((src_mailbox, dst_mailbox))
+
+    workers = []
+    failures = []  # list.append is thread-safe, no lock needed
+    for _ in range(max(1, min(args.workers, work_queue.qsize()))):
+        t = threading.Thread(target=worker_loop,
+                             args=(work_queue, src_cfg, dst_cfg, db_path,
+                                   args.dry_run, args.archive_src, failures))
+        t.start()
+        workers.append(t)
+    for t in workers:
+        t.join()
+
+    if failures:
+        if not work_queue.empty():
+            logging.error(f"{len(failures)} failure(s); "
+                          f"{work_queue.qsize()} folder(s) left unmigrated")
+        else:
+            logging.error(f"{len(failures)} failure(s) during migration; "
+                          "re-run to retry the affected folders")
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()